@@ -1,39 +1,176 @@
 import os
-import io
-import time
-import requests
-from huggingface_hub import InferenceClient
+import queue
+import signal
+import asyncio
+import contextlib
+import functools
+import hashlib
+import logging
+import logging.handlers
+import pathlib
+from collections import OrderedDict, deque
+from dataclasses import dataclass
+from enum import Enum
+from types import SimpleNamespace
+import aiohttp
+import diskcache
+import orjson
 from dotenv import load_dotenv
 
+logger = logging.getLogger(__name__)
+
 # ==========================================
 # 1. ENVIRONMENT CONFIGURATION
 # ==========================================
-# Load environment variables from the .env file once
-load_dotenv()
+# Default models: a distilled 1-4 step model for speed, full SDXL for '/hq' prompts
+DEFAULT_IMAGE_MODEL = "stabilityai/sdxl-turbo"
+DEFAULT_HQ_MODEL = "stabilityai/stable-diffusion-xl-base-1.0"
+
+@functools.cache
+def cfg():
+    """
+    Loads the API keys and model settings from the .env file / environment on first use and caches them.
+    Call cfg.cache_clear() (the bot does this on SIGHUP) to reload them without a restart.
+
+    Returns:
+        SimpleNamespace: 'tg' (Telegram bot token), 'hf' (Hugging Face token),
+                         'model' (fast model) and 'hq_model' (quality model).
+
+    Raises:
+        RuntimeError: If a key is missing, instead of silently building URLs with 'None'.
+    """
+    load_dotenv(override=True)
+
+    missing = [name for name in ("TELEGRAM_TOKEN", "HF_TOKEN") if not os.getenv(name)]
+    if missing:
+        raise RuntimeError(f"Missing environment variable(s): {', '.join(missing)}")
+
+    return SimpleNamespace(
+        tg=os.environ["TELEGRAM_TOKEN"],
+        hf=os.environ["HF_TOKEN"],
+        model=os.getenv("HF_IMAGE_MODEL", DEFAULT_IMAGE_MODEL),
+        hq_model=os.getenv("HF_HQ_MODEL", DEFAULT_HQ_MODEL)
+    )
+
+def tg_url(method):
+    """
+    Builds the Telegram Bot API URL for the given method (e.g. 'sendPhoto').
+    This is the only place where the token is put into a URL.
+    """
+    return f"https://api.telegram.org/bot{cfg().tg}/{method}"
+
+def redact(error):
+    """
+    Returns the error as text with every API token masked, so the details can be printed safely.
+    """
+    text = repr(error)
+    try:
+        config = cfg()
+    except RuntimeError:
+        # No keys loaded, so there is nothing to mask
+        return text
 
-# Retrieve sensitive keys safely using os.getenv
-# If the key is missing, it returns None instead of crashing the app
-TELEGRAM_TOKEN = os.getenv("TELEGRAM_TOKEN")
-HF_TOKEN = os.getenv("HF_TOKEN")
+    for secret in (config.tg, config.hf):
+        text = text.replace(secret, "***")
+    return text
 
 # ==========================================
 # 2. CLIENT INITIALIZATION
 # ==========================================
-def get_hf_client():
+# Single aiohttp session shared by every Telegram and Hugging Face call (created lazily inside the event loop)
+_SESSION = None
+
+# JSON bodies are encoded with orjson, so the content type is set explicitly
+JSON_HEADERS = {"Content-Type": "application/json"}
+
+# Gateway errors worth retrying. Only idempotent GETs are retried, so a photo is never sent twice.
+RETRY_STATUSES = {502, 503, 504}
+
+def get_session():
     """
-    Initializes and returns the Hugging Face Inference Client.
-    
+    Returns the shared aiohttp ClientSession, creating it on first use.
+
+    The connector keeps TLS connections to Telegram and Hugging Face alive between calls,
+    so only the first request to each host pays the TCP + TLS handshake.
+
     Returns:
-        InferenceClient: The authenticated client object for image generation.
+        aiohttp.ClientSession: The session reused for all HTTP requests.
     """
-    return InferenceClient(
-        api_key=HF_TOKEN
-    )
+    global _SESSION
+    if _SESSION is None or _SESSION.closed:
+        connector = aiohttp.TCPConnector(
+            limit=16,               # Max open connections in the pool
+            limit_per_host=16,      # Only two hosts (Telegram and Hugging Face) are ever used
+            keepalive_timeout=75,   # Keep idle connections hot between polls
+            ttl_dns_cache=300       # Skip repeated DNS lookups
+        )
+        _SESSION = aiohttp.ClientSession(connector=connector)
+    return _SESSION
+
+async def get_with_retry(url, timeout, retries=3, connect_retries=2, backoff_factor=0.5):
+    """
+    Sends a GET request on the shared session, retrying transient failures
+    (same policy as urllib3's Retry(total=3, connect=2, read=0, status_forcelist=[502, 503, 504])).
+
+    Gateway errors and failed connection attempts are retried with exponential backoff.
+    Read timeouts and SSL errors are raised immediately.
+
+    Args:
+        url (str): The request URL.
+        timeout (aiohttp.ClientTimeout): Timeout applied to each attempt.
+        retries (int): How many extra attempts are allowed in total.
+        connect_retries (int): How many of them may be spent on connection errors.
+        backoff_factor (float): Base delay in seconds, doubled on every retry.
+
+    Returns:
+        aiohttp.ClientResponse: The final response (the caller must release it).
+    """
+    connect_failures = 0
+    for attempt in range(retries + 1):
+        try:
+            response = await get_session().get(url, timeout=timeout)
+        except aiohttp.ClientSSLError:
+            # Certificate problems won't fix themselves
+            raise
+        except aiohttp.ClientConnectorError:
+            connect_failures += 1
+            if attempt == retries or connect_failures > connect_retries:
+                raise
+        else:
+            if response.status not in RETRY_STATUSES or attempt == retries:
+                return response
+
+            # Free the connection back to the pool before sleeping
+            response.release()
+
+        await asyncio.sleep(backoff_factor * 2 ** attempt)
+
+# Known Telegram transport errors, built once and shared by every Telegram call.
+# Order matters: ClientSSLError is a subclass of ClientConnectionError, so it must come first.
+_TG_ERRORS = (
+    (asyncio.TimeoutError, "⏳ TIMEOUT ERROR: Telegram did not respond in time."),
+    (aiohttp.ClientSSLError, "🔒 SSL ERROR: Certificate verification failed."),
+    (aiohttp.ClientConnectionError, "❌ NETWORK ERROR: Failed to reach Telegram. Check internet/DNS."),
+)
+
+def report_tg_error(error, action):
+    """
+    Prints a safe description of a failed Telegram call.
+
+    Args:
+        error (Exception): The exception raised by the call.
+        action (str): What the bot was doing, e.g. 'fetching updates'.
+    """
+    message = next((msg for exc_type, msg in _TG_ERRORS if isinstance(error, exc_type)), None)
+    if message is None:
+        logger.error("❌ TELEGRAM ERROR: An unknown error occurred while %s. Details: %s", action, redact(error))
+    else:
+        logger.warning("%s (while %s)", message, action)
 
 # ==========================================
 # 3. TELEGRAM POLLING FUNCTION
 # ==========================================
-def get_prompt_from_tele(last_update_id):
+async def get_prompt_from_tele(last_update_id):
     """
     Polls the Telegram API for new messages (Long Polling).
 
@@ -43,336 +180,624 @@ def get_prompt_from_tele(last_update_id):
 
     Returns:
         dict: A JSON dictionary containing the API response. 
-              Returns an empty dict {} if the request fails.
+              Returns an empty successful answer if the long poll timed out,
+              and an 'ok: false' answer if Telegram did not send valid JSON.
+
+    Raises:
+        aiohttp.ClientError: If the request still fails after get_with_retry's retries
+                             (e.g. SSL errors), so the main loop can back off.
     """
     
     # Construct the URL for the 'getUpdates' endpoint
-    # timeout=30 keeps the connection open for 30s to wait for new messages (Long Polling)
-    url_get_updates = f"https://api.telegram.org/bot{TELEGRAM_TOKEN}/getUpdates?timeout=30&offset={last_update_id}"
+    # timeout=50 keeps the connection open for up to 50s; Telegram answers immediately when a message arrives (Long Polling)
+    url_get_updates = f"{tg_url('getUpdates')}?timeout=50&offset={last_update_id}"
 
     try:
         # Send a GET request to Telegram
-        response = requests.get(url_get_updates, timeout=35)
-        
-        # Parse and return the JSON response directly
-        return response.json()
+        async with await get_with_retry(url_get_updates, aiohttp.ClientTimeout(total=55)) as response:
+            # Parse the raw bytes directly (orjson is several times faster than the stdlib parser,
+            # and skipping response.json() avoids its bytes -> str decode and content-type check)
+            try:
+                return orjson.loads(await response.read())
+            except orjson.JSONDecodeError:
+                # Server might be down (e.g. a 502 gateway page in HTML after get_with_retry gave up):
+                # report it as a failed poll so main logs it and backs off
+                return {
+                    "ok": False,
+                    "description": f"API ERROR: Invalid response from Telegram (HTTP {response.status}, server might be down)."
+                }
+
+    # Transient errors were already retried by get_with_retry; anything else propagates to the main loop.
+    except asyncio.TimeoutError:
+        # The long poll stalled: not worth a warning, just start the next cycle
+        # (an empty 'ok' answer, so main doesn't mistake it for a failed poll and back off)
+        return {"ok": True, "result": []}
 
-    except Exception as e:
-        # SAFE ERROR HANDLING
-        # We convert the error to string but DO NOT print it directly.
-        error_str = str(e).lower()
+# ==========================================
+# 4. IMAGE GENERATION FUNCTION
+# ==========================================
+# Prompts starting with this command use the quality model instead of the fast one
+HQ_COMMAND = "/hq"
 
-        # --- DETECT ERROR TYPE SAFELY ---
+# Distilled models (SDXL-Turbo, FLUX.1-schnell) need only a few steps and no classifier-free guidance
+FAST_PARAMETERS = {"num_inference_steps": 4, "guidance_scale": 0.0}
 
-        # CASE 1: Connection / DNS / Max Retries (The source of your previous leak)
-        if "connection" in error_str or "max retries" in error_str or "failed to resolve" in error_str:
-            print("❌ NETWORK ERROR: Failed to fetch updates from Telegram. Check internet/DNS.")
+# Hugging Face Inference endpoint; it answers with the encoded image bytes directly
+HF_API_URL = "https://router.huggingface.co/hf-inference/models/{model}"
 
-        # CASE 2: Read Timeout (Normal for Long Polling)
-        elif "read timed out" in error_str:
-            # This is actually normal in long polling if no message arrives in 30s.
-            # We can print a soft log or nothing at all.
-            print("⏳ Polling cycle refreshed (No new messages).")
+# Max concurrent generations, so a flood of prompts can't exhaust the quota at once
+MAX_CONCURRENT_GENERATIONS = 5
 
-        # CASE 3: SSL Errors
-        elif "ssl" in error_str:
-            print("🔒 SSL ERROR: Certificate verification failed.")
+# Created lazily inside the event loop (on Python 3.9 it would otherwise bind to the import-time loop)
+_GEN_SEMAPHORE = None
 
-        # CASE 4: Unknown Error
-        else:
-            print("❌ POLLING ERROR: An unknown error occurred while fetching updates.")
-            print("   (Error details hidden for security)")
-        
-        # Return an empty dictionary to ensure the main loop doesn't crash
-        return {}
+def get_gen_semaphore():
+    """
+    Returns the semaphore capping concurrent generations, creating it on first use.
+    """
+    global _GEN_SEMAPHORE
+    if _GEN_SEMAPHORE is None:
+        _GEN_SEMAPHORE = asyncio.Semaphore(MAX_CONCURRENT_GENERATIONS)
+    return _GEN_SEMAPHORE
+
+class GenStatus(Enum):
+    """Outcome of a generation attempt."""
+    OK = "ok"
+    AUTH = "auth"          # 401/403: Token is invalid or missing
+    CREDIT = "credit"      # 402: Credit balance depleted
+    QUOTA = "quota"        # 429: Rate limit reached
+    BUSY = "busy"          # 503: Model is loading
+    NET = "net"            # Connection / timeout
+    UNKNOWN = "unknown"
+
+@dataclass(frozen=True)
+class GenResult:
+    """
+    Result of generate_img.
 
-# ==========================================
-# 4. IMAGE GENERATION FUNCTION
-# ==========================================
-def generate_img(prompt: str):
+    Attributes:
+        status (GenStatus): What happened.
+        image (bytes): The encoded image, only set when status is OK.
+        message (str): Optional text to forward to the user instead of the generic error.
     """
-    Generates an image based on the text prompt using the Fal AI model.
-    Returns the image as a Byte Array (in-memory) for Telegram transmission.
+    status: GenStatus
+    image: bytes = None
+    message: str = None
+
+# Hugging Face HTTP status code -> (status, console message), built once at import
+_HF_ERRORS = {
+    401: (GenStatus.AUTH, "🔒 AUTH ERROR: Hugging Face Token is invalid or missing."),
+    403: (GenStatus.AUTH, "🔒 AUTH ERROR: Hugging Face Token is invalid or missing."),
+    402: (GenStatus.CREDIT, "💳 QUOTA EXCEEDED: Your Hugging Face credit balance is depleted. Purchase credits or upgrade to Pro."),
+    429: (GenStatus.QUOTA, "⏳ QUOTA ERROR: Hugging Face API rate limit reached. Please wait."),
+    503: (GenStatus.BUSY, "🏗️ MODEL BUSY: The model is currently loading on Hugging Face servers. Try again in 30s."),
+}
+
+# Persistent on-disk image cache (survives restarts), capped at 2 GiB
+_IMG_CACHE = diskcache.Cache("./.img_cache", size_limit=2 << 30)
+
+# In-process LRU of the most recently used images, checked before the disk cache
+_MEM_CACHE = OrderedDict()
+MEM_CACHE_SIZE = 256
+
+# Shortest prompt worth sending to the model
+MIN_PROMPT_LENGTH = 4
+
+def validate_prompt(prompt: str):
+    """
+    Cheap pre-filter that rejects prompts which can't produce a meaningful image,
+    so they never reach the expensive API.
+
+    Raises:
+        ValueError: With a user-facing explanation if the prompt is rejected.
     """
-    
-    # 1. INPUT VALIDATION
-    # Ensure the prompt is valid before calling the expensive API
     if prompt is None or prompt.strip() == "":
-        print("❌ Error: Received an empty prompt.")
-        # We raise a ValueError so the Main Flow knows this step failed
         raise ValueError("Prompt cannot be empty or None.")
 
-    print(f"🎨 Generating Image for: '{prompt}'")
+    prompt = prompt.strip()
+    if len(prompt) < MIN_PROMPT_LENGTH:
+        raise ValueError(f"Prompt is too short. Please describe the image in at least {MIN_PROMPT_LENGTH} characters.")
+    if not any(char.isalpha() for char in prompt):
+        raise ValueError("Prompt must contain words describing the image.")
 
-    try:
-        client = get_hf_client()
+def resolve_model(text: str):
+    """
+    Picks the model for a message: prompts starting with '/hq' use the quality model
+    (full SDXL), everything else the fast distilled model.
 
-        # 2. CALL GENERATION API
-        # Sending request to Black Forest Labs FLUX.1 model
-        image = client.text_to_image(
-            prompt,
-            model="stabilityai/stable-diffusion-xl-base-1.0",
-        )
+    Returns:
+        tuple: (prompt without the command, model id, extra generation parameters)
+    """
+    config = cfg()
+    words = text.split(maxsplit=1)
 
-        # 3. OUTPUT VALIDATION
-        # Safety check: Ensure the API actually returned an object
-        if not image:
-            raise ValueError("API returned an empty result (No Image).")
+    # Also accept the '/hq@BotName' form Telegram uses in group chats
+    if words and words[0].split("@")[0].lower() == HQ_COMMAND:
+        return (words[1] if len(words) > 1 else ""), config.hq_model, {}
+    return text, config.model, FAST_PARAMETERS
 
-        # 4. IMAGE PROCESSING (IN-MEMORY)
-        # Create a virtual file in RAM (BytesIO) to avoid saving to hard drive
-        img_bytes_arr = io.BytesIO()
-        
-        # Save the PIL image into the buffer as PNG format
-        image.save(img_bytes_arr, format="PNG")
-        
-        # Reset the cursor to the beginning of the file so it can be read later
-        img_bytes_arr.seek(0)
-        
-        print("✅ Image generated and converted to bytes successfully.")
-        return img_bytes_arr
+def normalize_prompt(prompt: str):
+    """
+    Canonicalizes a prompt so trivially different spellings share one cache entry.
+    Only used for the cache key; the model always receives the prompt as the user typed it.
+    """
+    return " ".join(prompt.lower().split())
 
-    except Exception as e:
-        # 5. SAFE ERROR HANDLING
-        # We convert the error to a string but DO NOT print it directly
-        # because it might contain the HF_TOKEN in the headers.
-        error_str = str(e).lower()
+def generation_key(prompt: str, model: str, parameters: dict):
+    """
+    Identifies a generation by model, sorted parameters and normalized prompt.
+    Used for both the image cache and the in-flight map, so the same prompt sent
+    in fast and '/hq' mode never shares a result, even if both modes use the same model.
+    """
+    params_key = orjson.dumps(parameters, option=orjson.OPT_SORT_KEYS).decode()
+    return hashlib.sha256(f"{model}|{params_key}|{normalize_prompt(prompt)}".encode()).hexdigest()
 
-        # --- DETECT ERROR TYPE SAFELY ---
+async def render_image(prompt: str, model: str, parameters: dict):
+    """
+    Calls the Hugging Face API and returns the encoded image as raw bytes,
+    exactly as the API sent them (no decode / re-encode round-trip).
+    Results are cached per generation_key, in memory and on disk, so a repeated
+    prompt skips the HTTPS round-trip entirely, even after a restart.
+    Failed calls raise and are therefore never cached.
+    """
+    key = generation_key(prompt, model, parameters)
+
+    # Look the image up in memory first, then on disk
+    if key in _MEM_CACHE:
+        _MEM_CACHE.move_to_end(key)
+        logger.debug("Memory cache hit for '%s'", prompt)
+        return _MEM_CACHE[key]
+
+    # Disk reads and writes of multi-MB images run in a worker thread to keep the event loop free
+    img_bytes = await asyncio.to_thread(_IMG_CACHE.get, key)
+
+    if img_bytes is not None:
+        logger.debug("Disk cache hit for '%s'", prompt)
+    else:
+        # Sending request to the selected model.
+        # x-use-cache lets Hugging Face serve identical requests from its inference cache.
+        headers = {
+            **JSON_HEADERS,
+            "Authorization": f"Bearer {cfg().hf}",
+            "x-use-cache": "true"
+        }
+        # Only the API call takes a generation slot, so cache hits never queue behind slow generations
+        async with get_gen_semaphore(), get_session().post(
+            HF_API_URL.format(model=model),
+            data=orjson.dumps({"inputs": prompt, "parameters": parameters}),
+            headers=headers,
+            timeout=aiohttp.ClientTimeout(total=120)
+        ) as response:
+            response.raise_for_status()
+
+            # Read the body once into a single buffer; the same bytes object is then
+            # cached and handed to every sendPhoto upload without further copies
+            img_bytes = await response.read()
+
+        # Safety check: Ensure the API actually returned an image
+        if not img_bytes:
+            raise ValueError("API returned an empty result (No Image).")
 
-        # CASE 1: Authentication Error (Wrong Token)
-        if "401" in error_str or "unauthorized" in error_str or "token" in error_str:
-            print("🔒 AUTH ERROR: Hugging Face Token is invalid or missing.")
+        await asyncio.to_thread(_IMG_CACHE.set, key, img_bytes)
 
-        # CASE 2: Rate Limit / Quota Exceeded (Free tier limits)
-        elif "429" in error_str or "quota" in error_str:
-            print("⏳ QUOTA ERROR: Hugging Face API rate limit reached. Please wait.")
+    _MEM_CACHE[key] = img_bytes
+    if len(_MEM_CACHE) > MEM_CACHE_SIZE:
+        _MEM_CACHE.popitem(last=False)
+    return img_bytes
 
-        # CASE 3: Model Loading (Common in HF Inference API)
-        elif "503" in error_str or "loading" in error_str:
-            print("🏗️ MODEL BUSY: The model is currently loading on Hugging Face servers. Try again in 30s.")
+async def generate_img(prompt: str, model: str, parameters: dict):
+    """
+    Generates an image based on the text prompt using the given model on Hugging Face.
+    Returns a GenResult holding the image bytes for Telegram transmission,
+    or the failure status. The prompt is expected to be validated by the caller.
+    """
+    
+    logger.info("🎨 Generating Image for: '%s' (%s)", prompt, model)
 
-        # CASE 4: Network/Connection Errors
-        elif "connection" in error_str or "max retries" in error_str:
-             print("❌ NETWORK ERROR: Failed to connect to Hugging Face API.")
+    try:
+        # 1. CALL GENERATION API (or reuse the cached bytes for this prompt)
+        img_bytes = await render_image(prompt, model, parameters)
+
+    # 2. SAFE ERROR HANDLING
+    # Errors are dispatched by type and never printed, because they might contain the Hugging Face token in the headers.
+    # CASE 1: HTTP Errors (Auth / Credit / Rate Limit / Model Loading), looked up by status code
+    except aiohttp.ClientResponseError as e:
+        status_code = e.status
+        status, message = _HF_ERRORS.get(
+            status_code,
+            (GenStatus.UNKNOWN, f"🔥 GENERATION FAILED: Hugging Face returned HTTP {status_code}.")
+        )
+        logger.error(message)
 
-        # CASE 5: API Key Quota / Credit Depleted
-        elif "credit balance" in error_str or "depleted" in error_str or "429" in error_str:
-            warning_msg = "💳 QUOTA EXCEEDED: Your Hugging Face credit balance is depleted. Purchase credits or upgrade to Pro."
-            print(warning_msg)
-            return warning_msg
+        # Only the depleted-credit warning is forwarded to the user as-is
+        return GenResult(status, message=message if status is GenStatus.CREDIT else None)
 
-        # CASE 6: Unknown Error
-        else:
-            print("🔥 GENERATION FAILED: An unknown error occurred during image generation.")
-            print("   (Error details hidden for security)")
+    # CASE 2: Network/Connection Errors
+    except (asyncio.TimeoutError, aiohttp.ClientConnectionError):
+        logger.error("❌ NETWORK ERROR: Failed to connect to Hugging Face API.")
+        return GenResult(GenStatus.NET)
+
+    # CASE 3: Unknown Error
+    except Exception as e:
+        logger.error("🔥 GENERATION FAILED: An unknown error occurred during image generation. Details: %s", redact(e))
+        return GenResult(GenStatus.UNKNOWN)
 
-        return None
+    logger.info("✅ Image generated successfully.")
+    return GenResult(GenStatus.OK, image=img_bytes)
 
 # ==========================================
 # 5. TELEGRAM SEND FUNCTION
 # ==========================================
-def to_telegram(sender_name, chat_id, caption, img):
+async def to_telegram(sender_name, chat_id, caption, img):
     """
     Sends the generated image and caption to the specified Telegram Chat.
-    """
 
-    if not TELEGRAM_TOKEN:
-        print("❌ Error: Telegram credentials are missing.")
-        return
+    Args:
+        img (bytes): The encoded image.
+    """
     
     # 1. CONSTRUCT API URL
-    url_send_photo = f"https://api.telegram.org/bot{TELEGRAM_TOKEN}/sendPhoto"
+    url_send_photo = tg_url("sendPhoto")
 
-    # 2. PREPARE FILE PAYLOAD
-    # We must send the file as a tuple: (filename, file_data, mime_type)
-    # This tells requests how to format the binary data properly.
-    files = {
-        "photo": ("generated_image.png", img, "image/png")
-    }
-
-    # 3. PREPARE DATA PAYLOAD
+    # 2. PREPARE MULTIPART PAYLOAD
     # Note: Telegram API keys are case-sensitive. Use 'chat_id', not 'CHAT_ID'.
-    data = {
-        "chat_id": chat_id, 
-        "caption": caption
-    }
-
-    print(f"🚀 Sending image to {sender_name} with Telegram Chat ID: {chat_id}...")
+    # The photo field carries the filename and mime type so Telegram parses the binary data properly.
+    # aiohttp writes the bytes part straight to the socket, so the image is never copied or buffered twice.
+    data = aiohttp.FormData()
+    data.add_field("chat_id", str(chat_id))
+    data.add_field("caption", caption)
+    # Hugging Face may answer with PNG or JPEG, so detect the format from the file signature
+    if img.startswith(b"\x89PNG"):
+        data.add_field("photo", img, filename="generated_image.png", content_type="image/png")
+    else:
+        data.add_field("photo", img, filename="generated_image.jpg", content_type="image/jpeg")
+
+    logger.info("🚀 Sending image to %s with Telegram Chat ID: %s...", sender_name, chat_id)
 
     try:
         # 4. Send the POST Request
-        response = requests.post(url_send_photo, files=files, data=data, timeout=60)
+        async with get_session().post(url_send_photo, data=data, timeout=aiohttp.ClientTimeout(total=60)) as response:
 
-        # 5. Validate Response
-        if response.status_code == 200:
-            print("✅ Success: Image delivered to Telegram!")
-        else:
-            # If the API returns an error (e.g., 400 Bad Request, 401 Unauthorized)
-            print(f"❌ Telegram Refused: Status Code {response.status_code}")
-            print(f"📄 Error Details: {response.text}")
+            # 5. Validate Response
+            if response.status == 200:
+                logger.info("✅ Success: Image delivered to Telegram!")
+            else:
+                # If the API returns an error (e.g., 400 Bad Request, 401 Unauthorized)
+                logger.error("❌ Telegram Refused: Status Code %s. Error Details: %s", response.status, await response.text())
 
     except Exception as e:
-        # SAFETY CHECK: Do NOT print 'e' directly because it might contain the URL with the Token.
-        error_str = str(e).lower()
-
-        # --- SAFE ERROR HANDLING ---
-        
-        # CASE 1: Connection / DNS Issues
-        if "connection" in error_str or "failed to resolve" in error_str or "max retries" in error_str:
-            print(f"❌ NETWORK ERROR: Failed to send image to {sender_name}. Check internet/DNS.")
-        
-        # CASE 2: Timeout
-        elif "timeout" in error_str:
-            print(f"⏳ TIMEOUT ERROR: Sending image to {sender_name} timed out.")
-        
-        # CASE 3: SSL / Certificate Errors
-        elif "ssl" in error_str or "certificate" in error_str:
-             print("🔒 SSL ERROR: Connection failed due to SSL verification issues.")
-
-        # CASE 4: Unknown Error
-        else:
-            print(f"❌ SENDING FAILED: An unknown error occurred while sending to {sender_name}.")
-            print("   (Error details hidden for security)")
+        # SAFE ERROR HANDLING (the raw error may contain the URL with the Token)
+        report_tg_error(e, f"sending image to {sender_name}")
 
 # ==========================================
 # 5B. TELEGRAM SEND TEXT FUNCTION
 # ==========================================
-def send_information(sender_name, chat_id, information):
+async def send_information(sender_name, chat_id, information):
     """
     Sends a text message (information or warning) to a specific Telegram user.
     """
     
-    # 1. Credential Check
-    if not TELEGRAM_TOKEN:
-        print("❌ Error: Telegram credentials are missing.")
-        return
+    # 1. Construct URL
+    url = tg_url("sendMessage")
 
-    # 2. Construct URL
-    url = f"https://api.telegram.org/bot{TELEGRAM_TOKEN}/sendMessage"
-
-    # 3. Prepare Data
+    # 2. Prepare Data
     data = {
         "chat_id": chat_id,
         "text": information,
         "parse_mode": "Markdown"
     }
 
-    # 4. Log Action
-    print(f"🚀 SENDING INFO TO {sender_name} (ID: {chat_id})...")
+    # 3. Log Action
+    logger.info("🚀 SENDING INFO TO %s (ID: %s)...", sender_name, chat_id)
 
     try:
-        # 5. Send POST request to Telegram API
-        response = requests.post(url, json=data)
-        
-        # 6. Check HTTP Status Code (200 = OK)
-        if response.status_code == 200:
-            print("Status: ✅ Message delivered!")
-        else:
-            # Log the specific error from Telegram for debugging
-            print(f"Status: ❌ Telegram Refused (Code: {response.status_code})")
-            print(f"Details: {response.text}")
-            
+        # 4. Send POST request to Telegram API
+        async with get_session().post(url, data=orjson.dumps(data), headers=JSON_HEADERS, timeout=aiohttp.ClientTimeout(total=35)) as response:
+
+            # 5. Check HTTP Status Code (200 = OK)
+            if response.status == 200:
+                logger.info("Status: ✅ Message delivered!")
+            else:
+                # Log the specific error from Telegram for debugging
+                logger.error("Status: ❌ Telegram Refused (Code: %s). Details: %s", response.status, await response.text())
+
     except Exception as e:
-        # 7. Safe Error Handling
-        # Parse the error string to determine the cause
-        error_str = str(e).lower()
-
-        if "connection" in error_str or "dns" in error_str:
-            print("Status: ❌ Network Error (Connection/DNS).")
-        elif "timeout" in error_str:
-            print("Status: ⏳ Timeout Error (No Response).")
-        elif "ssl" in error_str:
-            print("Status: 🔒 SSL Error (Certificate Failed).")
-        else:
-            print("Status: ❌ Send Failed (Unknown Error).")
-    
+        # 6. Safe Error Handling
+        report_tg_error(e, f"sending info to {sender_name}")
+
 # ==========================================
-# 6. MAIN BOT LOOP (BACKGROUND PROCESS)
+# 5C. TELEGRAM CHAT ACTION FUNCTION
 # ==========================================
-def main():
-    print("🤖 Bot is starting... Monitoring incoming messages...")
+async def send_chat_action(chat_id, action="upload_photo"):
+    """
+    Shows a status such as 'sending photo...' in the chat as an instant acknowledgement.
+    Telegram clears it after ~5 seconds or as soon as the bot sends the photo.
+    """
+    try:
+        async with get_session().post(
+            tg_url("sendChatAction"),
+            data=orjson.dumps({"chat_id": chat_id, "action": action}),
+            headers=JSON_HEADERS,
+            timeout=aiohttp.ClientTimeout(total=5)
+        ):
+            pass
+
+    except Exception as e:
+        # Best effort only: a failed acknowledgement must not stop the generation
+        report_tg_error(e, "sending chat action")
     
-    # Initialize the offset to 0 to receive new messages
-    last_update_id = 0
+# ==========================================
+# 6. PER-MESSAGE HANDLER
+# ==========================================
+# Generations currently running, keyed by generation_key (model, parameters and normalized prompt)
+_IN_FLIGHT = {}
+
+# Fire-and-forget chat actions, referenced here so they are not garbage-collected mid-flight
+_ACK_TASKS = set()
 
-    while True:
+async def generate_shared(prompt, model, parameters):
+    """
+    Runs generate_img as its own task, sharing a single Hugging Face call
+    between identical prompts that arrive while it is still running
+    (e.g. several users sending the same prompt in one polling batch).
+
+    Returns:
+        GenResult: The shared generation result.
+    """
+    key = generation_key(prompt, model, parameters)
+    task = _IN_FLIGHT.get(key)
+    if task is None:
+        task = asyncio.create_task(generate_img(prompt, model, parameters))
+        _IN_FLIGHT[key] = task
+        task.add_done_callback(lambda _: _IN_FLIGHT.pop(key, None))
+
+    # Shield the shared call so one cancelled waiter doesn't cancel it for the others
+    return await asyncio.shield(task)
+
+@contextlib.asynccontextmanager
+async def chat_turn(chat_locks, chat_id):
+    """
+    Holds the chat's lock for one reply. Locks are created on demand and dropped again
+    once no message of that chat is running or waiting, so the map only holds active chats.
+
+    Args:
+        chat_locks (dict): Maps chat_id -> [asyncio.Lock, number of holders and waiters].
+        chat_id: The Telegram chat the reply goes to.
+    """
+    # Registered before the first await, so the lock is still taken in arrival order
+    entry = chat_locks.setdefault(chat_id, [asyncio.Lock(), 0])
+    entry[1] += 1
+    try:
+        async with entry[0]:
+            yield
+    finally:
+        entry[1] -= 1
+        if not entry[1]:
+            del chat_locks[chat_id]
+
+async def handle_update(message, chat_locks):
+    """
+    Generates and delivers the image for a single Telegram message.
+
+    Runs as its own task so a slow generation for one chat never blocks
+    polling or replies for the others. The per-chat lock keeps replies
+    within the same chat in the order the prompts arrived.
+
+    Args:
+        message (dict): The 'message' object from a Telegram update.
+        chat_locks (dict): Per-chat locks, managed by chat_turn.
+    """
+    prompt = message["text"]
+    sender = message.get("from", {})
+    chat = message.get("chat", {})
+    sender_name = sender.get("first_name", "Unknown")
+    chat_id = chat.get("id", "Unknown")
+
+    # Log the received message details
+    logger.info("📩 RECEIVED MESSAGE from [%s]: '%s'", sender_name, prompt)
+
+    # Everything below may call cfg(), which raises if a SIGHUP reload left a key missing,
+    # so it all runs inside the guard instead of failing as an unretrieved task exception
+    try:
+        # Pick the fast or the '/hq' quality model and strip the command from the prompt
+        prompt, model, parameters = resolve_model(prompt)
+
+        # Reject obviously invalid prompts without calling Hugging Face
+        # (the reply still goes through the chat lock to keep replies in order)
         try:
-            # Poll Telegram servers for new updates
-            # 'last_update_id + 1' ensures we confirm previous messages and only get new ones
-            data = get_prompt_from_tele(last_update_id + 1)
-            
-            # Print raw data only if there's actual content (prevents console spam)
-            if "result" in data and len(data["result"]) > 0:
-                print(f"\n📦 Update Received: {len(data['result'])} new message(s).")
-            
-            # Check if the 'result' key exists and contains messages
-            if "result" in data and len(data["result"]) > 0:
-                for message in data["result"]:
-                    # Update the offset ID to acknowledge this message
-                    last_update_id = message["update_id"]
+            validate_prompt(prompt)
+        except ValueError as e:
+            logger.info("⚠️ Rejected prompt from %s: %s", sender_name, e)
+            async with chat_turn(chat_locks, chat_id):
+                await send_information(sender_name, chat_id, f"⚠️ {e}")
+            return
+
+        # Acknowledge right away so the user sees activity while the image is generated.
+        # Sent as a background task: awaiting it here would let later prompts take the chat lock first.
+        ack = asyncio.create_task(send_chat_action(chat_id))
+        _ACK_TASKS.add(ack)
+        ack.add_done_callback(_ACK_TASKS.discard)
+
+        async with chat_turn(chat_locks, chat_id):
+            # Generate image based on the user's prompt (shared with identical prompts in flight)
+            result = await generate_shared(prompt, model, parameters)
+
+            # If image generation was successful, send it back to Telegram
+            if result.status is GenStatus.OK:
+                await to_telegram(sender_name, chat_id, prompt, result.image)
+                logger.info("✅ Image sent successfully.")
+            elif result.message:
+                await send_information(sender_name, chat_id, result.message)
+            else:
+                logger.warning("⚠️ Image generation failed (%s).", result.status.value)
+                await send_information(sender_name, chat_id, "❌ Sorry, failed to generate image due to server error.")
+
+    except Exception as e:
+        logger.error("❌ HANDLER ERROR: Failed to process the message from %s. Details: %s", sender_name, redact(e))
+
+# ==========================================
+# 7. MAIN BOT LOOP (BACKGROUND PROCESS)
+# ==========================================
+# Seconds to wait before polling again after a failed poll or an unexpected error
+POLL_RETRY_DELAY = 5
+
+# Last acknowledged update_id, persisted so a restart doesn't re-run the last batch
+OFFSET_PATH = pathlib.Path(".tg_offset")
+
+def load_offset():
+    """
+    Returns the last acknowledged update_id from disk, or 0 if none was saved yet.
+    """
+    try:
+        return int(OFFSET_PATH.read_text())
+    except (OSError, ValueError):
+        return 0
+
+def save_offset(update_id):
+    """
+    Persists the last acknowledged update_id. The value is written to a temp file
+    and swapped in with os.replace, so a crash never leaves a half-written file.
+    """
+    tmp_path = OFFSET_PATH.with_suffix(".tmp")
+    try:
+        tmp_path.write_text(str(update_id))
+        os.replace(tmp_path, OFFSET_PATH)
+    except OSError as e:
+        logger.warning("⚠️ Could not save the polling offset: %s", e)
+
+async def main():
+    logger.info("🤖 Bot is starting... Monitoring incoming messages...")
+
+    # Fail fast if the API keys are missing
+    try:
+        cfg()
+    except RuntimeError as e:
+        logger.critical("❌ CONFIG ERROR: %s", e)
+        return
+
+    # Reload the API keys on SIGHUP without restarting the bot (not available on Windows)
+    if hasattr(signal, "SIGHUP"):
+        asyncio.get_running_loop().add_signal_handler(signal.SIGHUP, cfg.cache_clear)
+    
+    # Resume from the saved offset (0 on first start) so already handled messages aren't processed again
+    last_update_id = load_offset()
+
+    # Recently dispatched update_ids, guarding against Telegram re-delivering an update within this session
+    seen_update_ids = deque(maxlen=1024)
+
+    # One lock per chat keeps replies ordered inside a chat while different chats run concurrently
+    chat_locks = {}
+
+    # Hold references to running handlers so they are not garbage-collected mid-flight
+    tasks = set()
+
+    try:
+        while True:
+            try:
+                # Poll Telegram servers for new updates
+                # 'last_update_id + 1' ensures we confirm previous messages and only get new ones
+                data = await get_prompt_from_tele(last_update_id + 1)
+
+                # Only an 'ok: true' answer starts the next poll right away. A failed poll or an
+                # 'ok: false' answer (e.g. 401 bad token, 409 webhook / other poller active) would
+                # otherwise be retried in a tight loop, so log Telegram's reason and back off.
+                if not data.get("ok"):
+                    logger.warning("⚠️ POLLING FAILED: %s", data.get("description", "No valid response from Telegram."))
+                    logger.info("🔄 Retrying polling in %d seconds...", POLL_RETRY_DELAY)
+                    await asyncio.sleep(POLL_RETRY_DELAY)
+                    continue
+
+                # Look the results up once (an empty tuple if the poll returned nothing)
+                results = data.get("result") or ()
+
+                # Print raw data only if there's actual content (prevents console spam)
+                if results:
+                    logger.info("📦 Update Received: %d new message(s).", len(results))
+
+                for update in results:
+                    # Update the offset ID to acknowledge this update (even if it is skipped below)
+                    update_id = update["update_id"]
+                    last_update_id = max(last_update_id, update_id)
+
+                    # Skip updates that were already dispatched
+                    if update_id in seen_update_ids:
+                        continue
+                    seen_update_ids.append(update_id)
 
                     # Ensure the update contains a valid text message
-                    if "message" in message and "text" in message["message"]:
-                        prompt = message["message"]["text"]
-                        sender_name = message["message"].get("from", {}).get("first_name", "Unknown")
-                        chat_id = message["message"].get("chat", {}).get("id", "Unknown")
-
-                        # Log the received message details
-                        print(f"📩 RECEIVED MESSAGE from [{sender_name}]: '{prompt}'")
-
-                        # Generate image based on the user's prompt
-                        result = generate_img(prompt)
-                        
-                        # If image generation was successful, send it back to Telegram
-                        if result is None:
-                            print("⚠️ Image generation failed (returned None).")
-                            send_information(sender_name, chat_id, "❌ Sorry, failed to generate image due to server error.")
-                        elif isinstance(result, str):
-                            send_information(sender_name, chat_id, result)
-                        else:
-                            to_telegram(sender_name, chat_id, prompt, result)
-                            print("✅ Image sent successfully.")           
+                    message = update.get("message")
+                    if not message or "text" not in message:
+                        continue
 
-            else:
-                # No new messages found in this poll cycle
-                print("💤 No new messages... Waiting...", end='\r')
-
-            # Short delay to prevent hitting API rate limits
-            time.sleep(1)
-
-        except Exception as e:
-            # 1. Convert error to string and lowercase for easy matching
-            # We keep this in memory only, NEVER print it.
-            error_str = str(e).lower()
-
-            # --- IF-ELIF LOGIC TO DETECT ERROR TYPE ---
-
-            # CASE 1: Connection / Internet / DNS Errors
-            # (This was the cause of your previous token leak)
-            if "connection" in error_str or "failed to resolve" in error_str or "max retries" in error_str:
-                print("\n❌ NETWORK ERROR: Failed to connect to Telegram. Check your internet or DNS.")
-            
-            # CASE 2: Timeout Errors (Telegram is lagging)
-            elif "timeout" in error_str:
-                print("\n⏳ TIMEOUT ERROR: Telegram is not responding. Retrying...")
-
-            # CASE 3: JSON Decoding Errors (Server might be down or returned HTML instead of JSON)
-            elif "json" in error_str or "decode" in error_str:
-                print("\n⚠️ API ERROR: Invalid response from Telegram (Server might be down).")
-
-            # CASE 4: Unknown / Other Errors
-            # We do NOT print 'e' here to protect your Token.
-            else:
-                print("\n❌ CRITICAL ERROR: An unknown internal error occurred.")
-                print("   (Error details hidden for security)")
+                    # Dispatch without waiting so polling continues while the image is generated
+                    task = asyncio.create_task(handle_update(message, chat_locks))
+                    tasks.add(task)
+                    task.add_done_callback(tasks.discard)
+
+                # Persist the new offset once per batch
+                if results:
+                    save_offset(last_update_id)
+
+                # No sleep here after a successful poll: the long poll itself waits for new messages
+
+            except aiohttp.ClientError as e:
+                # Polling errors that get_with_retry gave up on (e.g. a persistent SSL error)
+                # SAFE ERROR HANDLING (the raw error may contain the URL with the Token)
+                report_tg_error(e, "fetching updates")
 
-            # Pause before restarting to avoid CPU spam
-            print("🔄 Restarting polling in 5 seconds...")
-            time.sleep(5)
+                # Pause before polling again instead of spinning on the same error
+                logger.info("🔄 Restarting polling in %d seconds...", POLL_RETRY_DELAY)
+                await asyncio.sleep(POLL_RETRY_DELAY)
+
+            except Exception as e:
+                # Anything reaching this point is an invalid response or an unexpected internal error.
+                logger.critical("❌ CRITICAL ERROR: An unknown internal error occurred. Details: %s", redact(e))
+
+                # Pause before restarting to avoid CPU spam
+                logger.info("🔄 Restarting polling in %d seconds...", POLL_RETRY_DELAY)
+                await asyncio.sleep(POLL_RETRY_DELAY)
+
+    finally:
+        # Close the shared HTTP session on shutdown
+        if _SESSION is not None:
+            await _SESSION.close()
 
 # ==========================================
-# 7. EXECUTION
+# 8. LOGGING SETUP
+# ==========================================
+def setup_logging():
+    """
+    Routes all log records through a queue, so console and file writes happen on a
+    background listener thread instead of the event loop.
+
+    Returns:
+        QueueListener: The started listener (call .stop() on shutdown to flush it).
+    """
+    formatter = logging.Formatter("%(asctime)s %(levelname)s %(message)s")
+
+    console_handler = logging.StreamHandler()
+    file_handler = logging.handlers.RotatingFileHandler(
+        "bot.log", maxBytes=10_000_000, backupCount=3, encoding="utf-8"
+    )
+    for handler in (console_handler, file_handler):
+        handler.setFormatter(formatter)
+
+    log_queue = queue.SimpleQueue()
+    queue_handler = logging.handlers.QueueHandler(log_queue)
+    # Pass the bare message through; the listener's handlers add timestamp and level
+    queue_handler.setFormatter(logging.Formatter("%(message)s"))
+
+    listener = logging.handlers.QueueListener(log_queue, console_handler, file_handler)
+    logging.basicConfig(level=logging.INFO, handlers=[queue_handler])
+    listener.start()
+    return listener
+
+# ==========================================
+# 9. EXECUTION
 # ==========================================
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    listener = setup_logging()
+    try:
+        asyncio.run(main())
+    finally:
+        listener.stop()